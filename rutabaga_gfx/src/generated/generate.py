@@ -11,8 +11,9 @@ root directory.
 
 from __future__ import print_function
 import argparse
-import multiprocessing.pool
+import hashlib
 import os
+import shutil
 import subprocess
 import sys
 import tempfile
@@ -25,42 +26,101 @@ FAIL_COLOR = '\033[1;31m'
 END_COLOR = '\033[0m'
 
 verbose = False
+use_cache = True
+
+# Arguments passed to bindgen for every module.
+BINDGEN_BASE_ARGS = ('bindgen', '--no-layout-tests', '--no-prepend-enum-name')
+
+# Previously generated bindings, keyed by a hash of all bindgen inputs.
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'crosvm-bindgen')
+
+
+def header_dependencies(header, clang_args):
+  """Returns the header and all files it includes, as reported by clang -M."""
+  result = subprocess.run(['clang', '-M', header] + clang_args,
+                          stdout=subprocess.PIPE, text=True, check=False)
+  if result.returncode != 0:
+    return None
+  # The output is a make rule, with lines continued by a trailing backslash.
+  return result.stdout.split(':', 1)[1].replace('\\\n', ' ').split()
+
+
+def cache_key(args, header, clang_args):
+  """Hashes the bindgen command line, bindgen and libclang versions and all included files.
+
+  The header path itself is left out, since it points into a temporary directory
+  when virglrenderer is cloned. Its contents are hashed with the other includes.
+
+  Returns None if any of the inputs cannot be determined.
+  """
+  try:
+    # With --verbose, bindgen also prints the version of the libclang it loads,
+    # which affects the generated bindings as well.
+    version = subprocess.run(['bindgen', '--version', '--verbose'],
+                             stdout=subprocess.PIPE, check=True).stdout
+    dependencies = header_dependencies(header, clang_args)
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  if dependencies is None:
+    return None
+
+  key = hashlib.sha256(version)
+  for arg in args:
+    if arg != header:
+      key.update(arg.encode() + b'\0')
+  for dependency in dependencies:
+    try:
+      with open(dependency, 'rb') as f:
+        key.update(f.read())
+    except OSError:
+      return None
+  return key.hexdigest()
+
 
 def generate_module(module_name, allowlist, blocklist, header, clang_args,
                     lib_name, derive_default):
+  output = module_name + '_bindings.rs'
   args = [
-    'bindgen',
-    '--no-layout-tests',
+    *BINDGEN_BASE_ARGS,
     '--allowlist-function', allowlist,
     '--allowlist-var', allowlist,
     '--allowlist-type', allowlist,
     '--blocklist-function', blocklist,
     '--blocklist-item', blocklist,
     '--blocklist-type', blocklist,
-    '--no-prepend-enum-name',
-    '-o', module_name + '_bindings.rs',
-  ];
-
-  if lib_name:
-    args.extend(['--raw-line',
-                 '#[cfg(feature = \"{}\")]'.format(module_name)])
-    args.extend(['--raw-line',
-                 '#[link(name = "{}")] extern {{}}'.format(lib_name)])
-
-  if derive_default:
-    args.append('--with-derive-default')
-
-  args.extend([header, '--'])
-  args.extend(clang_args)
+    '-o', output,
+    *(['--raw-line', f'#[cfg(feature = "{module_name}")]',
+       '--raw-line', f'#[link(name = "{lib_name}")] extern {{}}']
+      if lib_name else []),
+    *(['--with-derive-default'] if derive_default else []),
+    header, '--',
+    *clang_args,
+  ]
+  cache_path = None
+  if use_cache:
+    key = cache_key(args, header, clang_args)
+    if key:
+      cache_path = os.path.join(CACHE_DIR, key + '.rs')
+
+  if cache_path and os.path.exists(cache_path):
+    if verbose:
+      print('using cached bindings {}'.format(cache_path))
+    shutil.copyfile(cache_path, output)
+    return 'pass'
 
   if verbose:
     print(' '.join(args))
 
-  if subprocess.Popen(args).wait() == 0:
-    return 'pass'
-  else:
+  if subprocess.run(args, check=False).returncode != 0:
     return 'bindgen failed'
 
+  if cache_path:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    shutil.copyfile(output, cache_path)
+  return 'pass'
+
 
 def download_virgl(src, dst, branch):
   virgl_src = tempfile.TemporaryDirectory(prefix='virglrenderer-src')
@@ -75,7 +135,7 @@ def download_virgl(src, dst, branch):
   if verbose:
     print(' '.join(args))
 
-  if subprocess.Popen(args).wait() == 0:
+  if subprocess.run(args, check=False).returncode == 0:
     return True
   else:
     
@@ -96,15 +156,22 @@ def get_parser():
   parser.add_argument('--verbose', '-v',
                       action='store_true',
                       help='enable verbose output (default=%(default)s)')
+  parser.add_argument('--no_cache',
+                      action='store_true',
+                      help='always run bindgen instead of reusing previously '
+                           'generated bindings (default=%(default)s)')
   return parser
 
 
 def main(argv):
   global verbose
+  global use_cache
   os.chdir(os.path.dirname(sys.argv[0]))
   opts = get_parser().parse_args(argv)
   if opts.verbose:
     verbose = True
+  if opts.no_cache:
+    use_cache = False
 
   if opts.virglrenderer:
     if '://' in opts.virglrenderer:
@@ -136,8 +203,7 @@ def main(argv):
     ),
   )
 
-  pool = multiprocessing.pool.Pool(len(modules))
-  results = pool.starmap(generate_module, modules, 1)
+  results = [generate_module(*module) for module in modules]
 
   return_fail = False
   print('---')
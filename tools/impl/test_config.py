@@ -33,6 +33,10 @@ class TestOption(enum.Enum):
     # This test needs longer than usual to run.
     LARGE = "large"
 
+    # Test results depend on more than the test binary itself (e.g. the crosvm
+    # binary), so passing results must not be cached between runs.
+    DO_NOT_CACHE = "do_not_cache"
+
 # Configuration to restrict how and where tests of a certain crate can
 # be build and run.
 #
@@ -102,7 +106,7 @@ WIN64_DISABLED_CRATES = [
 CRATE_OPTIONS: dict[str, list[TestOption]] = {
     "base": [TestOption.SINGLE_THREADED, TestOption.LARGE],
     "cros_async": [TestOption.LARGE],
-    "crosvm": [TestOption.SINGLE_THREADED],
+    "crosvm": [TestOption.SINGLE_THREADED, TestOption.DO_NOT_CACHE],
     "crosvm_plugin": [
         TestOption.DO_NOT_BUILD_AARCH64,
         TestOption.DO_NOT_BUILD_ARMHF,
@@ -122,6 +126,7 @@ CRATE_OPTIONS: dict[str, list[TestOption]] = {
     "integration_tests": [  # b/180196508
         TestOption.SINGLE_THREADED,
         TestOption.LARGE,
+        TestOption.DO_NOT_CACHE,
         TestOption.DO_NOT_RUN_AARCH64,
         TestOption.DO_NOT_RUN_ON_FOREIGN_KERNEL,
     ],
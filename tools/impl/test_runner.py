@@ -5,14 +5,15 @@
 
 import argparse
 import functools
-import json
+import hashlib
 import os
-import random
+import queue
 import subprocess
 import sys
-from multiprocessing import Pool
+import threading
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from typing import Dict, Iterable, List, NamedTuple
+from typing import Dict, Iterable, List, NamedTuple, Optional
 import typing
 
 import test_target
@@ -24,6 +25,12 @@ from check_code_hygiene import (
     has_crlf_line_endings,
 )
 
+try:
+    # orjson parses the json output of cargo considerably faster than the json module.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # type: ignore
+
 USAGE = """\
 Runs tests for crosvm locally, in a vm or on a remote device.
 
@@ -45,6 +52,12 @@ responsiblity that runtime dependencies of crosvm are provided.
 
 The default test target can be managed with `./tools/set_test_target`
 
+Test binaries that passed on the target before and have not been rebuilt since
+are not executed again. To run all tests regardless, add the `--no-cache` flag.
+
+The number of test binaries executed in parallel can be limited with `--jobs`,
+e.g. if tests time out while competing for CPUs.
+
 To see full build and test output, add the `-v` or `--verbose` flag.
 """
 
@@ -61,20 +74,39 @@ LARGE_TEST_TIMEOUT_SECS = 120
 # significantly slower than native environments.
 EMULATION_TIMEOUT_MULTIPLIER = 2
 
-# Number of parallel processes for executing tests.
-PARALLELISM = 4
+# Upper bound for the default number of tests executed in parallel:
+# - Each test binary already runs its tests on one thread per CPU, and runs alongside the
+#   cargo build of the remaining crates.
+# - Tests on ssh and vm targets share one ssh connection, which only allows 10 sessions
+#   with the default sshd MaxSessions setting.
+MAX_DEFAULT_PARALLELISM = 8
+
+# Default limit of sessions per connection in sshd (MaxSessions). Tests on ssh and vm
+# targets are multiplexed over a single connection and fail once it is exceeded.
+MAX_SSH_SESSIONS = 10
+
+# Number of tests executed in parallel, defaults to the number of CPUs available to us up
+# to MAX_DEFAULT_PARALLELISM. Overridden by --jobs
+if hasattr(os, "sched_getaffinity"):
+    PARALLELISM = min(len(os.sched_getaffinity(0)), MAX_DEFAULT_PARALLELISM)
+else:
+    PARALLELISM = min(os.cpu_count() or 4, MAX_DEFAULT_PARALLELISM)
 
 CROSVM_ROOT = Path(__file__).parent.parent.parent.resolve()
 COMMON_ROOT = CROSVM_ROOT / "common"
 
+# Marker files for test executables that passed on a given target.
+TEST_CACHE_DIR = CROSVM_ROOT / ".test_cache"
+
 
 class ExecutableResults(object):
     """Container for results of a test executable."""
 
-    def __init__(self, name: str, success: bool, test_log: str):
+    def __init__(self, name: str, success: bool, test_log: str, cached: bool = False):
         self.name = name
         self.success = success
         self.test_log = test_log
+        self.cached = cached
 
 
 class Executable(NamedTuple):
@@ -100,22 +132,43 @@ class Crate(NamedTuple):
     path: Path
 
 
+# CRATE_OPTIONS as sets, so lookups do not need to scan the list of options.
+CRATE_OPTION_SETS = {crate: frozenset(options) for crate, options in CRATE_OPTIONS.items()}
+
+
+def crate_options(crate_name: str) -> frozenset[TestOption]:
+    return CRATE_OPTION_SETS.get(crate_name, frozenset())
+
+
+def should_build_crate(crate_name: str, target_arch: Arch):
+    options = crate_options(crate_name)
+    if TestOption.DO_NOT_BUILD in options:
+        return False
+    if TestOption.DO_NOT_BUILD_X86_64 in options and target_arch == "x86_64":
+        return False
+    if TestOption.DO_NOT_BUILD_AARCH64 in options and target_arch == "aarch64":
+        return False
+    if TestOption.DO_NOT_BUILD_ARMHF in options and target_arch == "armhf":
+        return False
+    if TestOption.DO_NOT_BUILD_WIN64 in options and target_arch == "win64":
+        return False
+    return True
+
+
+@functools.lru_cache(None)
 def get_workspace_excludes(target_arch: Arch):
-    for crate, options in CRATE_OPTIONS.items():
-        if TestOption.DO_NOT_BUILD in options:
-            yield crate
-        elif TestOption.DO_NOT_BUILD_X86_64 in options and target_arch == "x86_64":
-            yield crate
-        elif TestOption.DO_NOT_BUILD_AARCH64 in options and target_arch == "aarch64":
-            yield crate
-        elif TestOption.DO_NOT_BUILD_ARMHF in options and target_arch == "armhf":
-            yield crate
-        elif TestOption.DO_NOT_BUILD_WIN64 in options and target_arch == "win64":
-            yield crate
+    return tuple(crate for crate in CRATE_OPTIONS if not should_build_crate(crate, target_arch))
+
+
+def get_test_excludes():
+    """Crates that never run tests, so their test binaries do not need to be built."""
+    return [
+        crate for crate, options in CRATE_OPTION_SETS.items() if TestOption.DO_NOT_RUN in options
+    ]
 
 
 def should_run_executable(executable: Executable, target_arch: Arch):
-    options = CRATE_OPTIONS.get(executable.crate_name, [])
+    options = crate_options(executable.crate_name)
     if TestOption.DO_NOT_RUN in options:
         return False
     if TestOption.DO_NOT_RUN_X86_64 in options and target_arch == "x86_64":
@@ -129,11 +182,31 @@ def should_run_executable(executable: Executable, target_arch: Arch):
     return True
 
 
+def find_crate_dirs(path: str) -> Iterable[str]:
+    """
+    Yields all directories below `path` that contain a Cargo.toml.
+
+    Uses os.scandir directly and does not descend into cargo target or hidden
+    directories, which can contain a large number of files.
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name == "target" or entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.isfile(os.path.join(entry.path, "Cargo.toml")):
+                    yield entry.path
+                yield from find_crate_dirs(entry.path)
+
+
+@functools.lru_cache(None)
 def list_common_crates(target_arch: Arch):
-    excluded_crates = list(get_workspace_excludes(target_arch))
-    for path in COMMON_ROOT.glob("**/Cargo.toml"):
-        if not path.parent.name in excluded_crates:
-            yield Crate(name=path.parent.name, path=path.parent)
+    excluded_crates = set(get_workspace_excludes(target_arch))
+    return tuple(
+        Crate(name=os.path.basename(crate_dir), path=Path(crate_dir))
+        for crate_dir in find_crate_dirs(str(COMMON_ROOT))
+        if not os.path.basename(crate_dir) in excluded_crates
+    )
 
 
 def exclude_crosvm(target_arch: Arch):
@@ -154,7 +227,9 @@ def cargo(
     cmd = [
         "cargo",
         cargo_command,
-        "--message-format=json-diagnostic-rendered-ansi",
+        # Let cargo render diagnostics as text, so only artifacts are reported as json.
+        "--message-format=json-render-diagnostics",
+        "--color=always",
         *flags,
     ]
     if VERBOSE:
@@ -164,7 +239,6 @@ def cargo(
         cwd=cwd,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        text=True,
         env=env,
     )
 
@@ -172,29 +246,31 @@ def cargo(
 
     # Read messages as cargo is running.
     assert process.stdout
-    for line in iter(process.stdout.readline, ""):
+    for line in iter(process.stdout.readline, b""):
         # any non-json line is a message to print
-        if not line.startswith("{"):
+        if not line.startswith(b"{"):
+            text = line.decode("utf-8", errors="replace").rstrip()
             if VERBOSE:
-                print(line.rstrip())
-            messages.append(line.rstrip())
+                print(text)
+            else:
+                # Kept to be printed if the build fails.
+                messages.append(text)
             continue
-        json_line = json.loads(line)
-
-        # 'message' type lines will be printed
-        if json_line.get("message"):
-            message = json_line.get("message").get("rendered")
-            if VERBOSE:
-                print(message)
-            messages.append(message)
+        # Only artifacts are of interest, skip decoding all other json lines
+        # (e.g. build-script-executed or build-finished).
+        if not line.startswith(b'{"reason":"compiler-artifact"'):
+            continue
+        json_line = json_loads(line)
 
         # Collect info about test executables produced
-        elif json_line.get("executable"):
+        executable = json_line.get("executable")
+        if executable:
+            target = json_line.get("target")
             yield Executable(
-                Path(json_line.get("executable")),
+                Path(executable),
                 crate_name=json_line.get("package_id", "").split(" ")[0],
-                cargo_target=json_line.get("target").get("name"),
-                kind=json_line.get("target").get("kind")[0],
+                cargo_target=target.get("name"),
+                kind=target.get("kind")[0],
                 is_test=json_line.get("profile", {}).get("test", False),
                 is_fresh=json_line.get("fresh", False),
                 arch=build_arch,
@@ -212,19 +288,22 @@ def cargo_build_executables(
     build_arch: Arch,
     cwd: Path = Path("."),
     env: Dict[str, str] = {},
+    build_tests: bool = True,
+    test_flags: list[str] = [],
 ) -> Iterable[Executable]:
-    """Build all test binaries for the given list of crates."""
+    """
+    Build all test binaries for the given list of crates.
+
+    `test_flags` are only passed to the build of test binaries, which is skipped entirely
+    if `build_tests` is false.
+    """
     # Run build first, to make sure compiler errors of building non-test
     # binaries are caught.
     yield from cargo("build", cwd, flags, env, build_arch)
 
     # Build all tests and return the collected executables
-    yield from cargo("test", cwd, ["--no-run", *flags], env, build_arch)
-
-
-def build_common_crate(build_env: dict[str, str], build_arch: Arch, crate: Crate):
-    print(f"Building tests for: common/{crate.name}")
-    return list(cargo_build_executables([], build_arch, env=build_env, cwd=crate.path))
+    if build_tests:
+        yield from cargo("test", cwd, ["--no-run", *flags, *test_flags], env, build_arch)
 
 
 def build_all_binaries(target: TestTarget, build_arch: Arch):
@@ -243,14 +322,85 @@ def build_all_binaries(target: TestTarget, build_arch: Arch):
         build_arch,
         cwd=CROSVM_ROOT,
         env=build_env,
+        test_flags=[f"--exclude={crate}" for crate in get_test_excludes()],
     )
 
-    with Pool(PARALLELISM) as pool:
-        for executables in pool.imap(
-            functools.partial(build_common_crate, build_env, build_arch),
-            list_common_crates(build_arch),
-        ):
-            yield from executables
+    # Common crates are separate workspaces and cannot be built by a single cargo
+    # invocation. Build them one after another in the target directory of the crosvm
+    # workspace, so shared dependencies are only compiled once and every build can make
+    # use of all cores.
+    target_dir = testvm.cargo_target_dir()
+    for crate in list_common_crates(build_arch):
+        print(f"Building tests for: common/{crate.name}")
+        yield from cargo_build_executables(
+            [f"--target-dir={target_dir}"],
+            build_arch,
+            cwd=crate.path,
+            env=build_env,
+            build_tests=crate.name not in get_test_excludes(),
+        )
+
+
+class BackgroundBuild(threading.Thread):
+    """
+    Runs `build_all_binaries` in a background thread.
+
+    Executables are handed out as soon as cargo reports them, which allows tests to be
+    executed while the remaining crates are still building.
+    """
+
+    def __init__(self, target: TestTarget, build_arch: Arch):
+        super().__init__(daemon=True)
+        self.target = target
+        self.build_arch = build_arch
+        self.error: Optional[BaseException] = None
+        self.__queue: queue.Queue[Optional[Executable]] = queue.Queue()
+        self.__crosvm: Optional[Executable] = None
+        self.__crosvm_built = threading.Event()
+
+    def run(self):
+        try:
+            for executable in build_all_binaries(self.target, self.build_arch):
+                if not executable.is_test and executable.cargo_target == "crosvm":
+                    self.__crosvm = executable
+                    self.__crosvm_built.set()
+                self.__queue.put(executable)
+        except BaseException as e:
+            # Includes the SystemExit raised by `cargo` on build failures.
+            self.error = e
+        finally:
+            self.__crosvm_built.set()
+            self.__queue.put(None)
+
+    def executables(self, stop: Optional[threading.Event] = None) -> Iterable[Executable]:
+        """
+        Yields executables as they are built, until the build is finished or failed.
+
+        Returns early once `stop` is set, so consumers do not have to wait for the remaining
+        build when they shut down.
+        """
+        while not (stop and stop.is_set()):
+            try:
+                executable = self.__queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if executable is None:
+                return
+            yield executable
+
+    def crosvm_binary(self) -> Executable:
+        """Waits for the crosvm binary, which is built before any of the tests."""
+        self.__crosvm_built.wait()
+        if not self.__crosvm:
+            self.wait()
+            raise Exception("Cannot find crosvm executable")
+        return self.__crosvm
+
+    def wait(self):
+        """Waits for the build to finish and re-raises any error that occurred."""
+        self.join()
+        if self.error:
+            raise self.error
 
 
 def is_emulated(target: TestTarget, executable: Executable) -> bool:
@@ -263,7 +413,7 @@ def is_emulated(target: TestTarget, executable: Executable) -> bool:
 
 
 def get_test_timeout(target: TestTarget, executable: Executable):
-    large = TestOption.LARGE in CRATE_OPTIONS.get(executable.crate_name, [])
+    large = TestOption.LARGE in crate_options(executable.crate_name)
     timeout = LARGE_TEST_TIMEOUT_SECS if large else TEST_TIMEOUT_SECS
     if is_emulated(target, executable):
         return timeout * EMULATION_TIMEOUT_MULTIPLIER
@@ -271,18 +421,71 @@ def get_test_timeout(target: TestTarget, executable: Executable):
         return timeout
 
 
-def execute_test(target: TestTarget, executable: Executable):
+def get_test_args(executable: Executable):
+    options = crate_options(executable.crate_name)
+    args: list[str] = []
+    if TestOption.SINGLE_THREADED in options:
+        args += ["--test-threads=1"]
+    return args
+
+
+def test_cache_path(target: TestTarget, executable: Executable):
+    """Path of the marker file recording a successful run of `executable` on `target`."""
+    key = hashlib.sha256()
+    key.update(bytes(executable.binary_path))
+    for arg in sorted(get_test_args(executable)):
+        key.update(b"\0" + arg.encode())
+    key.update(b"\0" + str(target).encode())
+    return TEST_CACHE_DIR / key.hexdigest()
+
+
+def is_test_cached(target: TestTarget, executable: Executable):
+    """
+    Returns true if the executable passed on this target before and has not changed since.
+
+    Executables that cargo did not consider fresh have just been rebuilt, so they cannot
+    have a valid cache entry.
+    """
+    if not executable.is_fresh:
+        return False
+    if TestOption.DO_NOT_CACHE in crate_options(executable.crate_name):
+        return False
+    try:
+        marker_mtime = test_cache_path(target, executable).stat().st_mtime
+    except FileNotFoundError:
+        return False
+    return marker_mtime >= executable.binary_path.stat().st_mtime
+
+
+def cache_test_result(target: TestTarget, executable: Executable):
+    if TestOption.DO_NOT_CACHE in crate_options(executable.crate_name):
+        return
+    TEST_CACHE_DIR.mkdir(exist_ok=True)
+    test_cache_path(target, executable).touch()
+
+
+def execute_test(target: TestTarget, use_cache: bool, upload: bool, executable: Executable):
     """
     Executes a single test on the given test targed
 
-    Note: This function is run in a multiprocessing.Pool.
+    If `use_cache` is set, tests that passed before and have not changed since are not
+    executed again. If `upload` is set, the test binary is uploaded to remote targets
+    before and removed after execution, otherwise it has to be uploaded already.
+
+    Note: This function is run in a ThreadPool.
 
     Test output is hidden unless the test fails or VERBOSE mode is enabled.
     """
-    options = CRATE_OPTIONS.get(executable.crate_name, [])
-    args: list[str] = []
-    if TestOption.SINGLE_THREADED in options:
-        args += ["--test-threads=1"]
+    if use_cache and is_test_cached(target, executable):
+        return ExecutableResults(executable.name, True, "cached", cached=True)
+    result = run_test(target, executable, upload)
+    if use_cache and result.success:
+        cache_test_result(target, executable)
+    return result
+
+
+def run_test(target: TestTarget, executable: Executable, upload: bool):
+    args = get_test_args(executable)
 
     binary_path = executable.binary_path
 
@@ -304,6 +507,7 @@ def execute_test(target: TestTarget, executable: Executable):
             binary_path,
             args=args,
             timeout=get_test_timeout(target, executable),
+            upload=upload,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         )
@@ -323,41 +527,72 @@ def execute_test(target: TestTarget, executable: Executable):
 
 
 def execute_all(
-    executables: list[Executable],
+    executables: Iterable[Executable],
     target: test_target.TestTarget,
     repeat: int,
+    use_cache: bool = True,
+    stop: Optional[threading.Event] = None,
 ):
-    """Executes all tests in the `executables` list in parallel."""
-    executables = [e for e in executables if should_run_executable(e, target.arch)]
+    """
+    Executes all tests in `executables` in parallel as they become available.
+
+    Tests that passed in a previous run and have not been rebuilt since are skipped,
+    unless `use_cache` is false or tests are repeated to check for flakes.
+
+    `stop` is set once execution ends, including on errors. It should stop `executables`
+    from blocking, since shutting down the pool waits for the input to be consumed.
+    """
+    executables = (e for e in executables if should_run_executable(e, target.arch))
+    # Executables are dispatched one by one while they are streamed in from the build,
+    # otherwise tests would wait until a whole chunk has been built.
+    chunksize = 1
+    # Streamed test binaries run only once and are uploaded and removed by each test, so
+    # they do not pile up on the target.
+    remote_binaries: set[Path] = set()
+    upload = True
     if repeat > 1:
+        use_cache = False
+        executables = list(executables)
+        if target.ssh:
+            # Repeated binaries are uploaded once in a single transfer and left on the
+            # target until all tests are done.
+            remote_binaries = {e.binary_path for e in executables if e.kind != "proc-macro"}
+            test_target.upload_to_target(target, list(remote_binaries))
+            upload = False
+        # Run all tests once before repeating them, which spreads out the runs of each
+        # test just as well as shuffling, but keeps the order deterministic.
         executables = executables * repeat
-        random.shuffle(executables)
+        chunksize = max(1, len(executables) // (PARALLELISM * 4))
 
-    sys.stdout.write(f"Running {len(executables)} test binaries on {target}")
+    sys.stdout.write(f"Running test binaries on {target}")
     sys.stdout.flush()
-    with Pool(PARALLELISM) as pool:
-        for result in pool.imap(functools.partial(execute_test, target), executables):
-            if not result.success or VERBOSE:
-                msg = "passed" if result.success else "failed"
-                print()
-                print("--------------------------------")
-                print("-", result.name, msg)
-                print("--------------------------------")
-                print(result.test_log)
-            else:
-                sys.stdout.write(".")
-                sys.stdout.flush()
-            yield result
+    try:
+        with ThreadPool(PARALLELISM) as pool:
+            try:
+                for result in pool.imap_unordered(
+                    lambda executable: execute_test(target, use_cache, upload, executable),
+                    executables,
+                    chunksize,
+                ):
+                    if not result.success or VERBOSE:
+                        msg = "passed" if result.success else "failed"
+                        print()
+                        print("--------------------------------")
+                        print("-", result.name, msg)
+                        print("--------------------------------")
+                        print(result.test_log)
+                    else:
+                        sys.stdout.write(".")
+                        sys.stdout.flush()
+                    yield result
+            finally:
+                if stop:
+                    stop.set()
+    finally:
+        test_target.remove_from_target(target, list(remote_binaries))
     print()
 
 
-def find_crosvm_binary(executables: list[Executable]):
-    for executable in executables:
-        if not executable.is_test and executable.cargo_target == "crosvm":
-            return executable
-    raise Exception("Cannot find crosvm executable")
-
-
 def main():
     parser = argparse.ArgumentParser(usage=USAGE)
     parser.add_argument(
@@ -386,17 +621,45 @@ def main():
         default=1,
         help="Repeat each test N times to check for flakes.",
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Run all tests, even if they passed before and have not changed since.",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help=(
+            "Number of test binaries to execute in parallel. "
+            f"Defaults to the number of CPUs, but at most {MAX_DEFAULT_PARALLELISM}. "
+            "Twice as many run on ssh and vm targets, since they mostly wait on the target."
+        ),
+    )
     args = parser.parse_args()
-
-    global VERBOSE
-    VERBOSE = args.verbose  # type: ignore
-    os.environ["RUST_BACKTRACE"] = "1"
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
 
     target = (
         test_target.TestTarget(args.target) if args.target else test_target.TestTarget.default()
     )
     print("Test target:", target)
 
+    global VERBOSE, PARALLELISM
+    VERBOSE = args.verbose  # type: ignore
+    if args.jobs is not None:
+        PARALLELISM = args.jobs
+        if target.ssh and PARALLELISM > MAX_SSH_SESSIONS:
+            print(
+                f"Warning: Limiting --jobs to {MAX_SSH_SESSIONS}, the default number of ssh "
+                "sessions allowed per connection."
+            )
+            PARALLELISM = MAX_SSH_SESSIONS
+    elif target.ssh:
+        # Executing tests remotely is bound by waiting on the target, not by local CPUs.
+        PARALLELISM = min(2 * PARALLELISM, MAX_DEFAULT_PARALLELISM)
+    os.environ["RUST_BACKTRACE"] = "1"
+
     build_arch = args.arch or target.arch
     print("Building for architecture:", build_arch)
 
@@ -417,25 +680,40 @@ def main():
         print(*crlf_endings)
         sys.exit(-1)
 
-    executables = list(build_all_binaries(target, build_arch))
+    build = BackgroundBuild(target, build_arch)
+    build.start()
 
     if args.build_only:
+        for _ in build.executables():
+            pass
+        build.wait()
         print("Not running tests as requested.")
         sys.exit(0)
 
     # Upload dependencies plus the main crosvm binary for integration tests if the
     # crosvm binary is not excluded from testing.
-    extra_files = (
-        [find_crosvm_binary(executables).binary_path] if not exclude_crosvm(build_arch) else []
-    )
+    extra_files = [build.crosvm_binary().binary_path] if not exclude_crosvm(build_arch) else []
 
     test_target.prepare_target(target, extra_files=extra_files)
 
-    # Execute all test binaries
-    test_executables = [e for e in executables if e.is_test]
-    all_results = list(execute_all(test_executables, target, repeat=args.repeat))
+    # Execute all test binaries while they are being built
+    stop = threading.Event()
+    test_executables = (e for e in build.executables(stop) if e.is_test)
+    all_results = list(
+        execute_all(
+            test_executables,
+            target,
+            repeat=args.repeat,
+            use_cache=not args.no_cache,
+            stop=stop,
+        )
+    )
+    build.wait()
 
     failed = [r for r in all_results if not r.success]
+    cached = [r for r in all_results if r.cached]
+    if cached:
+        print(f"{len(cached)} of {len(all_results)} tests passed before and were not executed.")
     if len(failed) == 0:
         print("All tests passed.")
         sys.exit(0)
@@ -3,6 +3,7 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file
 import argparse
+import functools
 import platform
 import subprocess
 from pathlib import Path
@@ -53,6 +54,14 @@ BUILD_ENV = {
     "CARGO_TARGET_AARCH64_UNKNOWN_LINUX_GNU_LINKER": "aarch64-linux-gnu-gcc",
 }
 
+# Share one connection between all ssh and scp calls to the same remote, instead of
+# setting up a new connection for every test that is executed.
+SSH_CONTROL_OPTS = {
+    "ControlMaster": "auto",
+    "ControlPath": "/tmp/crosvm-ssh-%r@%h:%p",
+    "ControlPersist": "60s",
+}
+
 
 class Ssh:
     """Wrapper around subprocess to execute commands remotely via SSH."""
@@ -62,7 +71,7 @@ class Ssh:
 
     def __init__(self, hostname: str, opts: list[str] = []):
         self.hostname = hostname
-        self.opts = opts
+        self.opts = [*opts, *[f"-o{k}={v}" for k, v in SSH_CONTROL_OPTS.items()]]
 
     def run(self, cmd: str, **kwargs: Any):
         """Equivalent of subprocess.run"""
@@ -148,6 +157,7 @@ class TestTarget(object):
         return self.target_str
 
 
+@functools.lru_cache(None)
 def find_rust_lib_dir():
     cargo_path = Path(subprocess.check_output(["rustup", "which", "cargo"], text=True))
     if os.name == "posix":
@@ -223,12 +233,30 @@ def set_target(target: TestTarget, build_arch: Optional[Arch]):
     print(f"Target Architecture: {build_arch}")
 
 
+@functools.lru_cache(None)
+def get_host_exec_env():
+    """Environment for executing files on the host, built once and shared by all executions."""
+    env = os.environ.copy()
+    # Allow test binaries to find rust's test libs.
+    if os.name == "posix":
+        env["LD_LIBRARY_PATH"] = str(find_rust_lib_dir())
+    elif os.name == "nt":
+        if not env["PATH"]:
+            env["PATH"] = str(find_rust_lib_dir())
+        else:
+            env["PATH"] += ";" + str(find_rust_lib_dir())
+    else:
+        raise Exception(f"Unsupported build target: {os.name}")
+    return env
+
+
 def exec_file_on_target(
     target: TestTarget,
     filepath: Path,
     timeout: int,
     args: list[str] = [],
     extra_files: list[Path] = [],
+    upload: bool = True,
     **kwargs: Any,
 ):
     """Executes a file on the test target.
@@ -237,35 +265,27 @@ def exec_file_on_target(
     target) plus any additional extra files provided, then executed and
     deleted afterwards.
 
+    If `upload` is false, the files are expected to be uploaded already via
+    upload_to_target and are left on the target.
+
     If the test target is 'host', files will just be executed locally.
 
     Timeouts will trigger a subprocess.TimeoutExpired exception, which contanins
     any output produced by the subprocess until the timeout.
     """
-    env = os.environ.copy()
     if not target.ssh:
-        # Allow test binaries to find rust's test libs.
-        if os.name == "posix":
-            env["LD_LIBRARY_PATH"] = str(find_rust_lib_dir())
-        elif os.name == "nt":
-            if not env["PATH"]:
-                env["PATH"] = str(find_rust_lib_dir())
-            else:
-                env["PATH"] += ";" + str(find_rust_lib_dir())
-        else:
-            raise Exception(f"Unsupported build target: {os.name}")
-
         cmd_line = [str(filepath), *args]
         return subprocess.run(
             cmd_line,
-            env=env,
+            env=get_host_exec_env(),
             timeout=timeout,
             text=True,
             **kwargs,
         )
     else:
         filename = Path(filepath).name
-        target.ssh.upload_files([filepath] + extra_files, quiet=True)
+        if upload:
+            upload_to_target(target, [filepath] + extra_files)
         try:
             result = target.ssh.run(
                 f"chmod +x {filename} && sudo LD_LIBRARY_PATH=. ./{filename} {' '.join(args)}",
@@ -275,11 +295,23 @@ def exec_file_on_target(
             )
         finally:
             # Remove uploaded files regardless of test result
-            all_filenames = [filename] + [f.name for f in extra_files]
-            target.ssh.check_output(f"sudo rm {' '.join(all_filenames)}")
+            if upload:
+                remove_from_target(target, [filepath] + extra_files)
         return result
 
 
+def upload_to_target(target: TestTarget, files: list[Path]):
+    """Uploads files to the home directory of ssh and vm targets in a single transfer."""
+    if target.ssh and files:
+        target.ssh.upload_files(files, quiet=True)
+
+
+def remove_from_target(target: TestTarget, files: list[Path]):
+    """Removes files previously uploaded with upload_to_target."""
+    if target.ssh and files:
+        target.ssh.check_output(f"sudo rm -f {' '.join(Path(f).name for f in files)}")
+
+
 def exec_file(
     target: TestTarget,
     filepath: Path,